@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Measure the throughput of Summarise.parse_line in lines per second.
+
+Usage: ./benchmarks/summarise_throughput.py [outfile] [repeats]
+
+The output file (default: tests/fixtures/two.in) is read into memory first,
+so only the line classification and parsing is timed."""
+import os
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.path.join(root_dir, 'teptools'))
+
+import summarise  # noqa: E402
+
+
+def main():
+    outfile = os.path.join(root_dir, 'tests', 'fixtures', 'two.in')
+    repeats = 20
+
+    if len(sys.argv) > 1:
+        outfile = sys.argv[1]
+
+    if len(sys.argv) > 2:
+        repeats = int(sys.argv[2])
+
+    with open(outfile, 'r') as f:
+        lines = [line.strip() for line in f]
+
+    best = float('inf')
+
+    for _ in range(repeats):
+        s = summarise.Summarise(outfile, 180)
+        start = time.perf_counter()
+
+        for line in lines:
+            s.parse_line(line)
+
+        best = min(best, time.perf_counter() - start)
+
+    print('{:d} lines, best of {:d}: {:.0f} lines/s'.format(
+        len(lines), repeats, len(lines) / best))
+
+
+if __name__ == '__main__':
+    main()
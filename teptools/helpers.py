@@ -1,8 +1,49 @@
 """Teptools helpers."""
+import array
 import configparser
+import csv
 import glob
+import hashlib
+import importlib.machinery
+import importlib.util
+import json
+import multiprocessing
 import os
+import pickle
 import re
+import subprocess
+import sys
+import tempfile
+
+
+def load_script(name):
+    """Return the module of another teptools script, which has no .py
+    extension, loading it only once per process."""
+    if name in sys.modules:
+        return sys.modules[name]
+
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), name)
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+
+    try:
+        loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+
+    return module
+
+
+def term_cols(default):
+    """Return the number of columns of the terminal, or default if it cannot
+    be found (e.g. when the output is not a terminal)."""
+    try:
+        return int(subprocess.check_output(['stty', 'size']).split()[1])
+    except subprocess.CalledProcessError:
+        return default
 
 
 def parse_rcfile(rcfile, section, default):
@@ -25,29 +66,176 @@ def parse_rcfile(rcfile, section, default):
     for setting in default:
         config[setting] = parser[section].get(setting, default[setting])
 
-        if type(default[setting]) is list:
+        if (type(default[setting]) is list and
+                type(config[setting]) is str):
             config[setting] = [l.strip()
                                for l in config[setting].split(',')]
 
     return config
 
 
-def parse_inpfile(inpfile):
-    """Return the keywords and blocks from a ONETEP input file."""
-    block = False
-    config = {
-        'keywords': {},
-        'blocks': {}
+# Value of a keyword line, as opposed to a key value separator
+keyword_value = re.compile('^[0-9a-zA-Z.]*$')
+
+
+def keyword_line(line):
+    """Return the (key, value) of a keyword line, whose key and value are
+    separated by ':', '=' or only spaces, or None if it has no value."""
+    linesplit = line.split()
+
+    if len(linesplit) < 2:
+        return None
+
+    # Ignore a key value separator attached to the key
+    key = linesplit[0].rstrip(':=')
+    value = linesplit[1]
+
+    # Ignore key value separator
+    if len(linesplit) > 2 and not keyword_value.match(value):
+        value = linesplit[2]
+
+    return key, value
+
+
+# Parsed input files by absolute path, see read_inpfile
+inpfile_cache = {}
+
+
+class PositionsBlock():
+    """Atoms of a positions_abs block stored in compact arrays.
+
+    The species of the atoms are stored as indices into species, and the
+    coordinates as an N x 3 array of doubles flattened by rows. The optional
+    unit line is kept in unit.
+    """
+    def __init__(self, lines):
+        self.unit = ''
+        self.species = []
+        self.species_index = array.array('i')
+
+        if lines and len(lines[0].split()) == 1:
+            self.unit = lines[0].lower()
+            lines = lines[1:]
+
+        atoms = [line.split() for line in lines]
+        atoms = [atom for atom in atoms if len(atom) >= 4]
+        indices = {}
+
+        for atom in atoms:
+            if atom[0] not in indices:
+                indices[atom[0]] = len(self.species)
+                self.species.append(atom[0])
+
+            self.species_index.append(indices[atom[0]])
+
+        self.coords = array.array('d', [float(x) for atom in atoms
+                                        for x in atom[1:4]])
+
+    def __len__(self):
+        return len(self.species_index)
+
+    def __getitem__(self, i):
+        """Return the species and the coordinates of an atom."""
+        return (self.species[self.species_index[i]],
+                tuple(self.coords[3*i:3*i+3]))
+
+    def to_numpy(self):
+        """Return the coordinates as an N x 3 NumPy array."""
+        import numpy
+
+        return numpy.frombuffer(self.coords, dtype='d').reshape(-1, 3).copy()
+
+
+class LatticeBlock():
+    """Lattice vectors of a lattice_cart block stored as a 3 x 3 array of
+    doubles flattened by rows, with the optional unit line kept in unit."""
+    def __init__(self, lines):
+        self.unit = ''
+
+        if lines and len(lines[0].split()) == 1:
+            self.unit = lines[0].lower()
+            lines = lines[1:]
+
+        self.vectors = array.array('d', [float(x) for line in lines[:3]
+                                         for x in line.split()[:3]])
+
+    def __getitem__(self, i):
+        """Return a lattice vector."""
+        return tuple(self.vectors[3*i:3*i+3])
+
+    def to_numpy(self):
+        """Return the lattice vectors as a 3 x 3 NumPy array."""
+        import numpy
+
+        return numpy.frombuffer(self.vectors, dtype='d').reshape(3, 3).copy()
+
+
+class InputFile(dict):
+    """Keywords and blocks of a ONETEP input file.
+
+    It is a dict of the 'keywords' and the lines of the 'blocks', and block()
+    parses the known numeric blocks into arrays on first access.
+    """
+    numeric_blocks = {
+        'positions_abs': PositionsBlock,
+        'lattice_cart': LatticeBlock
     }
 
-    if not os.path.isfile(inpfile):
-        return {}
+    def __init__(self):
+        super().__init__(keywords={}, blocks={})
+        self.parsed = {}
+
+    def block(self, name):
+        """Return a numeric block parsed into arrays or the lines of any other
+        block, or None if the block does not exist."""
+        if name not in self['blocks']:
+            return None
+
+        if name not in self.parsed:
+            parse = self.numeric_blocks.get(name)
+            lines = self['blocks'][name]
+            self.parsed[name] = parse(lines) if parse else lines
+
+        return self.parsed[name]
+
+    def copy(self):
+        """Return a copy with its own keywords and block lines."""
+        config = InputFile()
+        config.merge(self)
+
+        return config
+
+    def merge(self, other):
+        """Override the keywords and blocks with copies of the ones of
+        another input file."""
+        self['keywords'].update(other['keywords'])
 
-    with open(inpfile, 'r') as f:
+        for name, lines in other['blocks'].items():
+            self['blocks'][name] = list(lines)
+            self.parsed.pop(name, None)
+
+
+def read_inpfile(inpfile):
+    """Return the keywords and blocks of a ONETEP input file itself and the
+    files it includes with includefile.
+
+    Every file is only parsed once per process, as long as its mtime and size
+    have not changed, and copies of the parsed files are returned."""
+    path = os.path.abspath(inpfile)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    if path in inpfile_cache and inpfile_cache[path][0] == stamp:
+        return inpfile_cache[path][1].copy(), list(inpfile_cache[path][2])
+
+    block = False
+    config = InputFile()
+    includes = []
+
+    with open(path, 'r') as f:
         for line in f:
             raw_line = line.strip()
             line = raw_line.lower()
-            linesplit = line.split()
 
             # Ignore comments and empty lines
             if (not line or
@@ -69,31 +257,93 @@ def parse_inpfile(inpfile):
 
             # Parse config outside of a block
             if not block:
-                key = False
-
-                if len(linesplit) == 2:
-                    key = linesplit[0]
-                    value = linesplit[1]
-                elif len(linesplit) > 2:
-                    key = linesplit[0]
-                    value = linesplit[1]
+                key, value = keyword_line(line) or (False, None)
 
-                    # Ignore key value separator
-                    regex = re.compile('^[0-9a-zA-Z.]*$')
-
-                    if not regex.match(value):
-                        value = linesplit[2]
-
-                if key:
+                if key == 'includefile':
+                    # Paths are case sensitive
+                    includes.append(raw_line.split(None, 1)[1].lstrip(
+                        ':=').strip().strip('"\''))
+                elif key:
                     config['keywords'][key] = value
 
             # If inside a block store every line
             if block:
                 config['blocks'][block].append(raw_line)
 
+    inpfile_cache[path] = (stamp, config.copy(), list(includes))
+
+    return config, includes
+
+
+def parse_inpfile(inpfile, parents=()):
+    """Return the keywords and blocks from a ONETEP input file.
+
+    The files included with includefile are followed, relative to the
+    directory of the file including them, and the keywords and blocks of a
+    file override the ones of the files it includes.
+
+    Keyword arguments:
+    parents -- absolute paths of the files including this one, to detect
+               includefile cycles
+    """
+    if not os.path.isfile(inpfile):
+        return {}
+
+    path = os.path.abspath(inpfile)
+
+    if path in parents:
+        raise ValueError('includefile cycle: ' +
+                         ' -> '.join(parents + (path,)))
+
+    own, includes = read_inpfile(path)
+
+    if not includes:
+        return own
+
+    config = InputFile()
+
+    for include in includes:
+        include = os.path.join(os.path.dirname(path), include)
+
+        if not os.path.isfile(include):
+            raise ValueError('includefile not found: ' + include +
+                             ' (included by ' + path + ')')
+
+        config.merge(parse_inpfile(include, parents + (path,)))
+
+    config.merge(own)
+
     return config
 
 
+def reverse_lines(file, block_size=65536):
+    """Yield the lines of a file from the last one to the first.
+
+    The file is read backwards in blocks of block_size bytes, so finding
+    lines near the end only reads the end of the file. The lines are
+    decoded as UTF-8 and keep their line endings."""
+    with open(file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b''
+
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            block = f.read(read_size) + remainder
+            lines = block.splitlines(True)
+
+            # The first line may continue in the previous block
+            remainder = lines.pop(0) if position > 0 else b''
+
+            for line in reversed(lines):
+                yield line.decode('utf-8')
+
+        if remainder:
+            yield remainder.decode('utf-8')
+
+
 def find_files(args, ext):
     """Return a list of files with the specified extension from arguments.
 
@@ -148,6 +398,25 @@ def find_files(args, ext):
     return files
 
 
+def parallel_map(func, files, jobs):
+    """Yield func(file) for each file in the same order as the files.
+
+    Keyword arguments:
+    func  -- a module level function, so that it can be sent to the workers
+    files -- a list of files
+    jobs  -- number of worker processes, the files are processed one at a
+             time in the current process if this is 1
+    """
+    if jobs <= 1 or len(files) <= 1:
+        for file in files:
+            yield func(file)
+
+        return
+
+    with multiprocessing.Pool(min(jobs, len(files))) as pool:
+        yield from pool.imap(func, files)
+
+
 def create_file(name, ext):
     """Create a new file from a file name. If a file with the same name already
     exists, it will suffix the file name with a new number."""
@@ -163,3 +432,307 @@ def create_file(name, ext):
             return newfile, open(newfile, 'a')
         else:
             index += 1
+
+
+class ParseCache():
+    """On-disk cache of parsed output files.
+
+    Each entry is keyed by the absolute path of the file and a key chosen by
+    the parser, and stores the parsed rows, the parser state and the byte
+    offset up to which the file has been parsed. The inode, size and mtime of
+    the file, and a hash of its first block and of the block ending at the
+    offset, are recorded so that replaced or rewritten files are parsed
+    again, whereas files that have only grown can be parsed from the offset.
+    Least recently used entries are evicted once the cache grows larger than
+    max_size bytes.
+    """
+    # Size of the blocks hashed to detect a file rewritten in place, e.g. by
+    # running a job again with its output redirected to the same file
+    block_size = 4096
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def entry_file(self, file, key):
+        """Return the path of the cache entry for a file and key."""
+        name = repr((os.path.abspath(file), key)).encode('utf-8')
+
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(name).hexdigest() + '.cache')
+
+    def fingerprint(self, file, offset):
+        """Return a hash of the first block of a file and of the block
+        ending at the offset."""
+        digest = hashlib.sha1()
+
+        with open(file, 'rb') as f:
+            digest.update(f.read(min(self.block_size, offset)))
+            f.seek(max(0, offset - self.block_size))
+            digest.update(f.read(min(self.block_size, offset)))
+
+        return digest.hexdigest()
+
+    def load(self, file, key):
+        """Return the cache entry of a file or None if it cannot be reused.
+
+        The returned entry has 'unchanged' set to True if the file has not
+        changed at all since it was cached."""
+        entry_file = self.entry_file(file, key)
+
+        try:
+            with open(entry_file, 'rb') as f:
+                entry = pickle.load(f)
+        except Exception:  # A missing or corrupted entry is a cache miss
+            return None
+
+        stat = os.stat(file)
+
+        if (entry['path'] != os.path.abspath(file) or
+                entry['key'] != key or
+                entry['inode'] != stat.st_ino or
+                stat.st_size < entry['offset'] or
+                (stat.st_size == entry['size'] and
+                 stat.st_mtime != entry['mtime']) or
+                entry.get('fingerprint') != self.fingerprint(
+                    file, entry['offset'])):
+            return None
+
+        entry['unchanged'] = (stat.st_size == entry['size'] and
+                              stat.st_mtime == entry['mtime'])
+
+        # Mark the entry as recently used
+        os.utime(entry_file)
+
+        return entry
+
+    def save(self, file, key, stat, offset, state, rows):
+        """Store the parsed rows and parser state of a file.
+
+        Keyword arguments:
+        stat   -- os.stat result of the file taken before it was read
+        offset -- byte offset of the end of the last fully parsed line
+        state  -- parser state to resume from the offset
+        rows   -- parsed rows up to the offset
+        """
+        entry = {
+            'path': os.path.abspath(file),
+            'key': key,
+            'inode': stat.st_ino,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'offset': offset,
+            'fingerprint': self.fingerprint(file, offset),
+            'state': state,
+            'rows': rows
+        }
+
+        # Replace the entry at once, so that other processes reading it at
+        # the same time never see a partly written entry
+        f = tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp',
+                                        delete=False)
+
+        try:
+            with f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+
+            os.replace(f.name, self.entry_file(file, key))
+        except BaseException:
+            os.remove(f.name)
+            raise
+
+        self.evict()
+
+    def parse(self, file, key, parse_line, get_state, set_state):
+        """Yield the rows parsed from a file using the cache.
+
+        Unchanged files are served from the cache and files that have grown
+        are only parsed from where the cached parse stopped.
+
+        Keyword arguments:
+        parse_line -- function returning the row of a line of the file, or a
+                      false value if there is none
+        get_state  -- function returning a copy of the parser state
+        set_state  -- function restoring the parser state
+        """
+        stat = os.stat(file)
+        entry = self.load(file, key)
+        offset = 0
+        rows = []
+        snapshot = None
+
+        if entry:
+            set_state(entry['state'])
+            yield from entry['rows']
+
+            if entry['unchanged'] and entry['offset'] == entry['size']:
+                return
+
+            offset = entry['offset']
+            rows = entry['rows']
+
+        with open(file, 'rb') as f:
+            f.seek(offset)
+
+            for line in f:
+                if line.endswith(b'\n'):
+                    offset += len(line)
+                else:
+                    # Only cache up to the last complete line, as the rest
+                    # may still be written by a running job.
+                    snapshot = (offset, get_state(), len(rows))
+
+                row = parse_line(line.decode('utf-8'))
+
+                if row:
+                    rows.append(row)
+                    yield row
+
+        if not snapshot:
+            snapshot = (offset, get_state(), len(rows))
+
+        self.save(file, key, stat, snapshot[0], snapshot[1],
+                  rows[:snapshot[2]])
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits."""
+        entries = []
+        total_size = 0
+
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.cache'):
+                continue
+
+            entry_file = os.path.join(self.cache_dir, name)
+
+            # Entries may be removed by another process at the same time
+            try:
+                stat = os.stat(entry_file)
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry_file))
+            total_size += stat.st_size
+
+        for mtime, size, entry_file in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(entry_file)
+            except OSError:
+                pass
+
+            total_size -= size
+
+
+class Records():
+    """Typed numeric records stored column by column in compact arrays.
+
+    Keyword arguments:
+    columns -- a list of (name, typecode) pairs, where the typecode is one
+               from the array module (e.g., 'i' for int and 'd' for float)
+    """
+    def __init__(self, columns):
+        self.column_types = list(columns)
+        self.names = [name for name, _ in columns]
+        self.columns = [array.array(typecode) for _, typecode in columns]
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __iter__(self):
+        """Iterate over the records as tuples."""
+        return zip(*self.columns)
+
+    def __getitem__(self, name):
+        """Return the column with the specified name."""
+        return self.columns[self.names.index(name)]
+
+    def append(self, record):
+        """Append a record given as a tuple in the order of the columns."""
+        for column, value in zip(self.columns, record):
+            column.append(value)
+
+    def copy(self):
+        """Return a copy of the records."""
+        records = Records(self.column_types)
+        records.columns = [array.array(column.typecode, column)
+                           for column in self.columns]
+
+        return records
+
+    def to_dicts(self):
+        """Return the records as a list of dicts."""
+        return [dict(zip(self.names, record)) for record in self]
+
+    def to_numpy(self):
+        """Return a dict of NumPy arrays, one for each column."""
+        import numpy
+
+        return {name: numpy.frombuffer(column, dtype=column.typecode).copy()
+                for name, column in zip(self.names, self.columns)}
+
+
+def write_records(f, files, records, fmt):
+    """Write the records of each file in csv or json format.
+
+    Keyword arguments:
+    f       -- file object to write to
+    files   -- names of the files the records were parsed from
+    records -- a list of Records, one for each file
+    fmt     -- either 'csv' or 'json'
+    """
+    if fmt == 'json':
+        json.dump([{'file': file, 'records': r.to_dicts()}
+                   for file, r in zip(files, records)], f, indent=2)
+        f.write('\n')
+        return
+
+    writer = csv.writer(f, lineterminator='\n')
+
+    for i, (file, r) in enumerate(zip(files, records)):
+        if i == 0:
+            writer.writerow(['file'] + r.names)
+
+        for record in r:
+            writer.writerow((file,) + record)
+
+
+def output_records(files, records, fmt, iswrite):
+    """Print the records of all the files or write each into its own file.
+
+    Keyword arguments:
+    files   -- names of the files the records were parsed from
+    records -- a list of Records, one for each file
+    fmt     -- either 'csv' or 'json', also used as the new files extension
+    iswrite -- whether to write each file's records into its own file
+    """
+    if not iswrite:
+        write_records(sys.stdout, files, records, fmt)
+        return
+
+    for file, r in zip(files, records):
+        filename = os.path.splitext(os.path.basename(file))[0]
+        newfile, f = create_file(filename, fmt)
+        write_records(f, [file], [r], fmt)
+        f.close()
+        print(file + ' ' + fmt + ' > ' + newfile)
+
+
+def parse_cache(config, use_cache=True):
+    """Return a ParseCache from the configurations or None if disabled.
+
+    Keyword arguments:
+    config    -- configurations with 'cache_dir' and 'cache_size' (in MB)
+    use_cache -- whether the user allowed the cache to be used
+    """
+    cache_dir = os.path.expandvars(os.path.expanduser(config['cache_dir']))
+
+    if not use_cache or not cache_dir:
+        return None
+
+    return ParseCache(cache_dir, float(config['cache_size']) * 1024 * 1024)
@@ -1,4 +1,5 @@
 """Test create script."""
+import json
 import os
 import shutil
 import pytest
@@ -29,6 +30,22 @@ def setup(request):
     request.addfinalizer(fin)
 
 
+@pytest.fixture
+def setup_sweep(request):
+    cwd = os.getcwd()
+    os.chdir(fixtures_dir)
+    os.mkdir('pot')
+    open(os.path.join('pot', 'w1.pot'), 'a').close()
+    open(os.path.join('pot', 'S2.pot'), 'a').close()
+
+    def fin():
+        shutil.rmtree('pot')
+        shutil.rmtree('cutoff_radius')
+        os.chdir(cwd)
+
+    request.addfinalizer(fin)
+
+
 @pytest.fixture
 def create_potfiles(request):
     potdir = 'pot'
@@ -234,3 +251,189 @@ def test_create(monkeypatch, setup):
     assert cutoff_all_out == cutoff_all_expected
     assert radius_out == radius_expected
     assert radius_all_out == radius_all_expected
+
+
+def test_parse_range():
+    """Test parse_range function."""
+    assert create.parse_range('cutoff=600:800:100') == (
+        'cutoff', ['600', '700', '800'])
+    assert create.parse_range('radius=7:8:0.25') == (
+        'radius', ['7.00', '7.25', '7.50', '7.75', '8.00'])
+
+    with pytest.raises(SystemExit):
+        create.parse_range('cutoff=600:800')
+
+
+def test_create_sweep(setup_sweep):
+    """Test main function with a two dimensional sweep."""
+    name = 'WS'
+    inpfile = name + '.dat'
+    args = (name + ' -e W S --cell create.cell '
+            '--sweep cutoff=1000:1100:100 radius=10:11:1')
+    create.main(args.split(), 'teptoolsrc')
+
+    with open(os.path.join('cutoff_radius', inpfile), 'r') as f:
+        out = f.read()
+
+    assert 'cutoff_energy' not in out
+    assert '%block species\n' not in out
+
+    with open(os.path.join('cutoff_radius', 'sweep.json'), 'r') as f:
+        manifest = json.load(f)
+
+    assert manifest['input'] == inpfile
+    assert manifest['parameters'] == ['cutoff', 'radius']
+    assert [p['dir'] for p in manifest['points']] == [
+        '1000-10', '1000-11', '1100-10', '1100-11']
+    assert manifest['points'][1]['values'] == {'cutoff': 1000, 'radius': 11}
+
+    with open(os.path.join('cutoff_radius', '1100-11', inpfile), 'r') as f:
+        assert f.read() == (
+            'includefile: ../WS.dat\n\n'
+            'cutoff_energy: 1100 eV\n'
+            '%block species\n'
+            'W   W    74 -1 11\n'
+            'S   S    16 -1 11\n'
+            '%endblock species')
+
+
+def test_pot_index(monkeypatch, tmpdir):
+    """The index should be reused until the potdir changes and the chosen pot
+    files should be remembered."""
+    potdir = tmpdir.mkdir('pot')
+    cache_dir = str(tmpdir.join('cache'))
+    potdir.join('w1.pot').write('')
+    potdir.join('W2.pot').write('')
+    potdir.join('Se.pot').write('')
+    monkeypatch.setitem(__builtins__, 'input', lambda _: '2')
+    index = create.PotIndex(str(potdir), cache_dir)
+
+    assert index.candidates('W') == ['w1.pot', 'W2.pot']
+    assert index.candidates('S') == []
+    assert index.candidates('Se') == ['Se.pot']
+    assert index.choose('W', {'W': 'w1.pot'}) == 'w1.pot'
+    assert index.choose('W') == 'W2.pot'
+
+    def no_input(_):
+        raise AssertionError('input() should not be called')
+
+    monkeypatch.setitem(__builtins__, 'input', no_input)
+    monkeypatch.setattr(create.os, 'listdir', no_input)
+    index = create.PotIndex(str(potdir), cache_dir)
+
+    assert index.choose('W') == 'W2.pot'
+    assert index.choose('Se') == 'Se.pot'
+
+    monkeypatch.undo()
+    potdir.join('W3.pot').write('')
+    index = create.PotIndex(str(potdir), cache_dir)
+
+    assert index.candidates('W') == ['w1.pot', 'W2.pot', 'W3.pot']
+    assert index.choose('W') == 'W2.pot'
+
+
+def test_parse_potfiles():
+    """Test parse_potfiles function."""
+    assert create.parse_potfiles(['W: W2.pot', 'S:s1.pot', '']) == {
+        'W': 'W2.pot', 'S': 's1.pot'}
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_create_batch(tmpdir, jobs):
+    """Input files should be created for every structure with the elements
+    detected from each of them."""
+    potdir = tmpdir.mkdir('pot')
+
+    for potfile in ['Mo.pot', 'S.pot', 'Se.pot', 'W.pot']:
+        potdir.join(potfile).write('')
+
+    xyz = tmpdir.join('traj.xyz')
+    xyz.write(
+        '2\n'
+        'Lattice="10.0 0.0 0.0 0.0 11.0 0.0 0.0 0.0 12.0" Properties=...\n'
+        'W 0.0 0.0 0.0\n'
+        'S 1.0 1.5 2.0\n'
+        '2\n'
+        'Lattice="10.0 0.0 0.0 0.0 11.0 0.0 0.0 0.0 12.0"\n'
+        'W 0.0 0.0 0.0\n'
+        'S 1.0 1.5 2.5\n')
+    outdir = tmpdir.join('inputs')
+    rcfile = tmpdir.join('teptoolsrc')
+    rcfile.write('[create]\noptions =\ntemplates = ' +
+                 os.path.abspath(os.path.join(fixtures_dir, 'create.dat')) +
+                 '\npotdir = ' + str(potdir) + '\n')
+    args = [str(outdir), '-j', str(jobs), '--batch', str(xyz),
+            os.path.join(fixtures_dir, 'create.cell')]
+    create.main(args, str(rcfile))
+
+    assert sorted(os.listdir(str(outdir))) == [
+        'create.dat', 'traj_0.dat', 'traj_1.dat']
+
+    with open(str(outdir.join('create.dat')), 'r') as f:
+        out = f.read()
+
+    assert 'Mo  Mo   42 -1 10.0\n' in out
+    assert 'Se  "{}"\n'.format(potdir.join('Se.pot')) in out
+
+    with open(str(outdir.join('traj_1.dat')), 'r') as f:
+        out = f.read()
+
+    assert 'W   W    74 -1 10.0\nS   S    16 -1 10.0\n' in out
+    assert 'Mo' not in out
+    assert ('%block positions_abs\nang\n'
+            'W        0.000000000000      0.000000000000      0.000000000000\n'
+            'S        1.000000000000      1.500000000000      2.500000000000\n'
+            '%endblock positions_abs') in out
+    assert ('%block lattice_cart\nang\n'
+            '     10.000000000000      0.000000000000      0.000000000000\n'
+            ) in out
+
+
+def test_create_batch_names(tmpdir, capsys):
+    """Structures with the same name should be written to distinct input
+    files and structures without absolute positions should be skipped."""
+    potdir = tmpdir.mkdir('pot')
+
+    for potfile in ['Mo.pot', 'S.pot', 'Se.pot', 'W.pot']:
+        potdir.join(potfile).write('')
+
+    with open(os.path.join(fixtures_dir, 'create.cell'), 'r') as f:
+        cell = f.read()
+
+    tmpdir.mkdir('a').join('create.cell').write(cell)
+    tmpdir.mkdir('b').join('create.cell').write(cell)
+    tmpdir.join('frac.cell').write(
+        '%block positions_frac\nW 0.0 0.0 0.0\n%endblock positions_frac\n')
+    outdir = tmpdir.join('inputs')
+    rcfile = tmpdir.join('teptoolsrc')
+    rcfile.write('[create]\noptions =\ntemplates = ' +
+                 os.path.abspath(os.path.join(fixtures_dir, 'create.dat')) +
+                 '\npotdir = ' + str(potdir) + '\n')
+    create.main([str(outdir), '--batch', str(tmpdir.join('a')),
+                 str(tmpdir.join('b')), str(tmpdir.join('frac.cell'))],
+                str(rcfile))
+
+    assert sorted(os.listdir(str(outdir))) == ['create.dat', 'create_1.dat']
+    out = capsys.readouterr().out
+    assert 'create already used, writing create_1\n' in out
+    assert 'frac has no lattice_cart or positions_abs block, skipping' in out
+
+
+def test_create_without_potdir(tmpdir, monkeypatch):
+    """The potdir should only be needed when the template has a species_pot
+    block."""
+    template = tmpdir.join('template.dat')
+    template.write('task : singlepoint\n')
+    rcfile = tmpdir.join('teptoolsrc')
+    rcfile.write('[create]\noptions =\ntemplates = ' + str(template) + '\n')
+    monkeypatch.chdir(tmpdir)
+    create.main(['foo', '-e', 'W'], str(rcfile))
+
+    assert tmpdir.join('foo.dat').read() == 'task : singlepoint\n'
+
+    template.write('%block species_pot\n%endblock species_pot\n')
+
+    with pytest.raises(SystemExit) as exc:
+        create.main(['bar', '-e', 'W'], str(rcfile))
+
+    assert exc.value.code == 'potdir not set in your config file'
@@ -32,3 +32,45 @@ def test_main(capsys, chdir_fixtures):
     assert out == ('fixtures -14338.56459039093170\n'
                    'fixtures -14348.98291773412348\n'
                    'not_finished.out <-- not finished\n')
+
+
+def test_final_energy_cache(tmpdir):
+    """final_energy should give the same result when served from the
+    cache."""
+    cache = enerconv.helpers.ParseCache(str(tmpdir), 1e6)
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    expected = (True, '-14348.98291773412348')
+
+    assert (enerconv.final_energy(outfile, cache) == expected and
+            enerconv.final_energy(outfile, cache) == expected and
+            cache.load(outfile, 'enerconv')['unchanged'])
+
+
+def test_final_energy_running(tmpdir, monkeypatch):
+    """Only the end of an output which has not completed should be read."""
+    outfile = tmpdir.join('running.out')
+    outfile.write('   1   -10.5  <-- CG\n' + 'line\n' * 10000)
+    read = []
+    reverse_lines = enerconv.helpers.reverse_lines
+
+    def counted_reverse_lines(file):
+        for line in reverse_lines(file):
+            read.append(line)
+            yield line
+
+    monkeypatch.setattr(enerconv.helpers, 'reverse_lines',
+                        counted_reverse_lines)
+
+    assert enerconv.final_energy(str(outfile)) == (False, None)
+    assert len(read) <= enerconv.completed_lines + 1
+
+
+def test_main_jobs(capsys, chdir_fixtures):
+    """Reading with a process pool should keep the order of the files."""
+    enerconv.main(['two.in', 'not_finished.out', 'two.in', '-j', '2'],
+                  'emptyrc')
+    out, err = capsys.readouterr()
+
+    assert out == ('fixtures -14348.98291773412348\n'
+                   'not_finished.out <-- not finished\n'
+                   'fixtures -14348.98291773412348\n')
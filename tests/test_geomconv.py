@@ -1,5 +1,6 @@
 """Test geomconv script."""
 import os
+import json
 import pytest
 import geomconv
 
@@ -59,3 +60,57 @@ def test_side_view(capsys):
         expected = f.read()
 
     assert out == expected
+
+
+def test_main_format_json(capsys):
+    """--format json should print the records of each BFGS iteration."""
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    geomconv.main([outfile, '--format', 'json'], 'emptyrc')
+    out, err = capsys.readouterr()
+    out = json.loads(out)
+    records = out[0]['records']
+
+    assert (out[0]['file'] == outfile and
+            [r['N'] for r in records] == [0, 1, 2, 3, 4] and
+            records[4]['dE_ion'] == 6.567619e-07 and
+            records[4]['F_max'] == 7.328007e-04 and
+            records[4]['dR_max'] == 8.293901e-04)
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_geomconv_direct(use_cache, tmpdir):
+    """Geomconv should read the BFGS iterations straight from the output file
+    and give the same table with or without the cache."""
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    expected_file = os.path.join(fixtures_dir, 'two_expected.geomconv')
+    cache = None
+
+    if use_cache:
+        cache = geomconv.helpers.ParseCache(str(tmpdir), 1e6)
+
+    with open(expected_file, 'r') as f:
+        expected = f.read().splitlines()
+
+    # Run twice so that the second run is served from the cache
+    for _ in range(2):
+        g = geomconv.Geomconv(outfile, cache)
+        g.run(True)
+
+        assert g.outputs == expected and len(g.records) == 5
+
+
+def test_side_view_three_files(monkeypatch, capsys):
+    """Three outfiles should be printed side-by-side on a wide terminal."""
+    monkeypatch.setattr(geomconv.helpers.subprocess, 'check_output',
+                        lambda *args, **kwargs: b'50 252')
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    geomconv.main([outfile] * 3, 'emptyrc')
+    out, err = capsys.readouterr()
+
+    with open(os.path.join(fixtures_dir, 'two_expected.geomconv')) as f:
+        expected = f.read().splitlines()
+
+    assert out.splitlines() == [
+        '{:<{}}'.format(line, 84 + len(line) -
+                        len(geomconv.ansi_escape.sub('', line))) * 3
+        for line in expected]
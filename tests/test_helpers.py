@@ -1,6 +1,8 @@
 """Test helpers module."""
 import os
+import sys
 import glob
+import json
 import pytest
 import helpers
 
@@ -52,6 +54,16 @@ def test_parse_rcfile(section, default, expected):
     assert config == expected
 
 
+def test_load_script(monkeypatch):
+    """Scripts should be loaded once and kept in sys.modules."""
+    monkeypatch.delitem(sys.modules, 'enerconv', raising=False)
+    enerconv = helpers.load_script('enerconv')
+
+    assert sys.modules['enerconv'] is enerconv
+    assert helpers.load_script('enerconv') is enerconv
+    assert callable(enerconv.final_energy)
+
+
 def test_parse_inpfile():
     """Test parse_rcfile function."""
     inpfile = os.path.join(fixtures_dir, 'check.dat')
@@ -89,6 +101,81 @@ def test_parse_inpfile():
     assert config == expected
 
 
+def test_parse_inpfile_blocks():
+    """Numeric blocks should be parsed into arrays on first access."""
+    inpfile = os.path.join(fixtures_dir, 'check.dat')
+    config = helpers.parse_inpfile(inpfile)
+    positions = config.block('positions_abs')
+    lattice = config.block('lattice_cart')
+
+    assert config.block('positions_abs') is positions
+    assert positions.unit == 'ang'
+    assert len(positions) == 3
+    assert positions.species == ['S', 'Mo']
+    assert list(positions.species_index) == [0, 0, 1]
+    assert list(positions.coords) == [0.0, 0.0, 0.0, 0.515, 0.515, 0.314,
+                                      1.34, 1.34, 1.34]
+    assert positions[2] == ('Mo', (1.34, 1.34, 1.34))
+    assert lattice.unit == 'ang'
+    assert lattice[1] == (0.0, 30.2303, 0.0)
+    assert config.block('species') == config['blocks']['species']
+    assert config.block('not_exists') is None
+
+
+def test_parse_inpfile_includefile(monkeypatch, tmpdir):
+    """Included files should be parsed once and overridden by the files
+    including them."""
+    opened = []
+
+    def counting_open(file, *args, **kwargs):
+        opened.append(file)
+
+        return open(file, *args, **kwargs)
+
+    tmpdir.join('WS.dat').write(
+        'task : singlepoint\ncutoff_energy : 800 eV\n'
+        '%block species\nW W 74 -1 10.0\n%endblock species\n')
+
+    for cutoff in ['900', '1000', '1100']:
+        tmpdir.mkdir(cutoff).join('WS.dat').write(
+            'includefile: ../WS.dat\n\ncutoff_energy: ' + cutoff + ' eV')
+
+    monkeypatch.setattr(helpers, 'open', counting_open, raising=False)
+
+    for cutoff in ['900', '1000', '1100']:
+        config = helpers.parse_inpfile(str(tmpdir.join(cutoff, 'WS.dat')))
+
+        assert config['keywords'] == {'task': 'singlepoint',
+                                      'cutoff_energy': cutoff}
+        assert config['blocks'] == {'species': ['W W 74 -1 10.0']}
+
+    assert opened.count(str(tmpdir.join('WS.dat'))) == 1
+
+    # Changes to a parsed file should not change the cached files
+    config['keywords']['task'] = 'x'
+    config['blocks']['species'].append('S S 16 -1 10.0')
+    parent = helpers.parse_inpfile(str(tmpdir.join('WS.dat')))
+    parent['keywords']['task'] = 'y'
+    parent['blocks']['species'].append('S S 16 -1 10.0')
+
+    for file in [str(tmpdir.join('WS.dat')),
+                 str(tmpdir.join('900', 'WS.dat'))]:
+        config = helpers.parse_inpfile(file)
+
+        assert config['keywords']['task'] == 'singlepoint'
+        assert config['blocks'] == {'species': ['W W 74 -1 10.0']}
+
+    tmpdir.join('1000', 'WS.dat').write('includefile: ../not_exists.dat\n')
+
+    with pytest.raises(ValueError):
+        helpers.parse_inpfile(str(tmpdir.join('1000', 'WS.dat')))
+
+    tmpdir.join('WS.dat').write('includefile: 900/WS.dat\n')
+
+    with pytest.raises(ValueError):
+        helpers.parse_inpfile(str(tmpdir.join('900', 'WS.dat')))
+
+
 @pytest.mark.parametrize('args, expected', [
     ([fixtures_dir],
         [os.path.join(fixtures_dir, 'one.out')]),
@@ -119,3 +206,176 @@ def test_create_file(remove_output):
             os.path.isfile('one.summary') and
             os.path.isfile('one_1.summary') and
             os.path.isfile('one_2.summary'))
+
+
+def test_parse_cache(tmpdir):
+    """ParseCache should reuse entries of unchanged or grown files only."""
+    outfile = tmpdir.join('foo.out')
+    outfile.write('line1\n')
+    cache = helpers.ParseCache(str(tmpdir.join('cache')), 1024 * 1024)
+    stat = os.stat(str(outfile))
+
+    assert cache.load(str(outfile), 'key') is None
+
+    cache.save(str(outfile), 'key', stat, 6, {'foo': 1}, ['row'])
+    entry = cache.load(str(outfile), 'key')
+
+    assert (entry['unchanged'] and entry['offset'] == 6 and
+            entry['state'] == {'foo': 1} and entry['rows'] == ['row'])
+    assert cache.load(str(outfile), 'other_key') is None
+
+    outfile.write('line2\n', mode='a')
+    entry = cache.load(str(outfile), 'key')
+
+    assert not entry['unchanged'] and entry['offset'] == 6
+
+    outfile.write('new\n')
+
+    assert cache.load(str(outfile), 'key') is None
+
+
+def test_parse_cache_rewritten(tmpdir):
+    """A file truncated and written again in place should be parsed again
+    once it has grown past the cached offset."""
+    outfile = tmpdir.join('foo.out')
+    outfile.write('old1\nold2\n')
+    cache = helpers.ParseCache(str(tmpdir.join('cache')), 1024 * 1024)
+    state = {}
+
+    def parse():
+        return list(cache.parse(str(outfile), 'key', str.strip,
+                                lambda: dict(state), state.update))
+
+    assert parse() == ['old1', 'old2']
+
+    inode = os.stat(str(outfile)).st_ino
+    outfile.write('new1\n')
+    outfile.write('new2\nnew3\n', mode='a')
+
+    assert os.stat(str(outfile)).st_ino == inode
+    assert parse() == ['new1', 'new2', 'new3']
+
+
+def test_parse_cache_corrupted(tmpdir):
+    """A partly written entry should be a cache miss, and entries should be
+    replaced at once."""
+    outfile = tmpdir.join('foo.out')
+    outfile.write('line1\n')
+    cache = helpers.ParseCache(str(tmpdir.join('cache')), 1024 * 1024)
+    stat = os.stat(str(outfile))
+    cache.save(str(outfile), 'key', stat, 6, {'foo': 1}, ['row'] * 100)
+    entry_file = cache.entry_file(str(outfile), 'key')
+
+    assert os.listdir(cache.cache_dir) == [os.path.basename(entry_file)]
+
+    with open(entry_file, 'rb') as f:
+        data = f.read()
+
+    with open(entry_file, 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+    assert cache.load(str(outfile), 'key') is None
+
+
+def test_parse_cache_evict(tmpdir):
+    """ParseCache should remove the least recently used entries once the
+    cache is larger than its maximum size."""
+    cache = helpers.ParseCache(str(tmpdir.join('cache')), 1)
+    outfile = tmpdir.join('foo.out')
+    outfile.write('line1\n')
+    stat = os.stat(str(outfile))
+    cache.save(str(outfile), 'key', stat, 6, {}, ['row'])
+
+    assert os.listdir(cache.cache_dir) == []
+
+
+def test_parse_cache_config(tmpdir):
+    """parse_cache should only return a cache if it is enabled."""
+    cache_dir = str(tmpdir.join('cache'))
+
+    assert helpers.parse_cache({'cache_dir': '', 'cache_size': '1'}) is None
+    assert helpers.parse_cache(
+        {'cache_dir': cache_dir, 'cache_size': '1'}, False) is None
+
+    cache = helpers.parse_cache({'cache_dir': cache_dir, 'cache_size': '1'})
+
+    assert cache.cache_dir == cache_dir and cache.max_size == 1024 * 1024
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_parallel_map(jobs):
+    """parallel_map should keep the order of the files."""
+    files = ['a', 'bb', 'ccc', 'dddd']
+
+    assert list(helpers.parallel_map(len, files, jobs)) == [1, 2, 3, 4]
+
+
+def test_records():
+    """Records should store typed values column by column."""
+    records = helpers.Records([('i', 'i'), ('x', 'd')])
+    records.append((1, 0.5))
+    records.append((2, 1.5))
+    copied = records.copy()
+    records.append((3, 2.5))
+
+    assert (len(records) == 3 and len(copied) == 2 and
+            list(records) == [(1, 0.5), (2, 1.5), (3, 2.5)] and
+            list(records['x']) == [0.5, 1.5, 2.5] and
+            copied.to_dicts() == [{'i': 1, 'x': 0.5}, {'i': 2, 'x': 1.5}])
+
+
+def test_records_to_numpy():
+    """to_numpy should return a NumPy array for each column."""
+    numpy = pytest.importorskip('numpy')
+    records = helpers.Records([('i', 'i'), ('x', 'd')])
+    records.append((1, 0.5))
+    arrays = records.to_numpy()
+
+    assert (arrays['i'].dtype == numpy.intc and
+            arrays['x'].dtype == numpy.float64 and
+            arrays['x'].tolist() == [0.5])
+
+
+@pytest.mark.parametrize('fmt, expected', [
+    ('csv', 'file,i,x\na,1,0.5\nb,2,1.5\n'),
+    ('json', '[{"file": "a", "records": [{"i": 1, "x": 0.5}]}, '
+             '{"file": "b", "records": [{"i": 2, "x": 1.5}]}]')
+])
+def test_write_records(fmt, expected, tmpdir):
+    """write_records should write the records of all the files."""
+    records = [helpers.Records([('i', 'i'), ('x', 'd')]) for _ in range(2)]
+    records[0].append((1, 0.5))
+    records[1].append((2, 1.5))
+    outfile = tmpdir.join('records')
+
+    with open(str(outfile), 'w') as f:
+        helpers.write_records(f, ['a', 'b'], records, fmt)
+
+    out = outfile.read()
+
+    if fmt == 'json':
+        assert json.loads(out) == json.loads(expected)
+    else:
+        assert out == expected
+
+
+@pytest.mark.parametrize('contents', [
+    '',
+    'one line without ending',
+    'line1\nline2\n\nline4\n',
+    'windows\r\nline endings\r\n',
+    'multibyte Å characters\nééé\nend'
+])
+@pytest.mark.parametrize('block_size', [1, 2, 3, 7, 65536])
+def test_reverse_lines(contents, block_size, tmpdir):
+    """reverse_lines should yield the same lines as reading the whole file
+    then reversing it, regardless of the block size."""
+    outfile = tmpdir.join('foo.out')
+
+    with open(str(outfile), 'wb') as f:
+        f.write(contents.encode('utf-8'))
+
+    with open(str(outfile), 'r', encoding='utf-8', newline='') as f:
+        expected = list(reversed(f.readlines()))
+
+    assert list(helpers.reverse_lines(str(outfile), block_size)) == expected
@@ -1,5 +1,8 @@
 """Test run script."""
 import os
+import hashlib
+import json
+import subprocess
 import pytest
 import run
 
@@ -21,6 +24,7 @@ def setup(request):
         os.remove(inpfile)
         os.remove(onetep)
         os.remove(outfile)
+        os.remove('onetep.usage.json')
 
     request.addfinalizer(fin)
 
@@ -60,5 +64,315 @@ def test_main(iswrite, capsys, setup):
 
     if iswrite:
         assert os.path.isfile('onetep.out')
+        assert os.path.isfile('onetep.usage.json')
 
     assert not err
+
+
+@pytest.fixture
+def setup_sweep(tmpdir):
+    """Create a cutoff convergence test and a fake ONETEP which prints an
+    energy depending on the cutoff energy."""
+    energies = {'600': '-10.0', '700': '-10.01', '800': '-10.0101',
+                '900': '-10.0102'}
+    onetep = tmpdir.join('onetep')
+    onetep.write(
+        '#!/bin/sh\n'
+        'cutoff=$(grep -o "cutoff_energy: [0-9]*" "$1" | cut -d " " -f 2)\n'
+        'case $cutoff in\n' +
+        ''.join('{}) energy={};;\n'.format(k, v)
+                for k, v in energies.items()) +
+        'esac\n'
+        'echo "   2     0.00000076113412 $energy  <-- CG"\n'
+        'echo "Job completed: foo"\n')
+    os.chmod(str(onetep), 0o744)
+    rcfile = tmpdir.join('teptoolsrc')
+    rcfile.write('[run]\noptions =\npaths = ' + str(onetep) + '\n')
+    cutoff = tmpdir.mkdir('cutoff')
+    cutoff.join('WS.dat').write(
+        '%block positions_abs\nang\nW 0.0 0.0 0.0\nS 1.0 1.0 1.0\n'
+        '%endblock positions_abs\n')
+
+    for value in energies:
+        cutoff.mkdir(value).join('WS.dat').write(
+            'includefile: ../WS.dat\n\ncutoff_energy: ' + value + ' eV')
+
+    return str(rcfile), str(cutoff)
+
+
+def test_sweep(capsys, setup_sweep):
+    """A sweep should stop running points once the energy has converged."""
+    rcfile, cutoff = setup_sweep
+    run.main(['--sweep', cutoff], rcfile)
+    out, err = capsys.readouterr()
+
+    assert (out == ('600 -10.00000000000000\n'
+                    '700 -10.01000000000000 5.0000e-03 Ha/atom\n'
+                    '800 -10.01010000000000 5.0000e-05 Ha/atom\n' +
+                    cutoff + ' converged at 700\n') and
+            os.path.isfile(os.path.join(cutoff, '800', 'WS.out')) and
+            not os.path.isfile(os.path.join(cutoff, '900', 'WS.out')))
+
+
+def test_sweep_not_converged(capsys, setup_sweep):
+    """A sweep should run every point if the energy never converges."""
+    rcfile, cutoff = setup_sweep
+    run.main(['--sweep', cutoff, '--tolerance', '1e-6'], rcfile)
+    out, err = capsys.readouterr()
+
+    assert out.endswith(cutoff + ' not converged within 1e-06 Ha/atom\n')
+
+
+def test_sweep_zero_tolerance(capsys, setup_sweep):
+    """An explicit zero tolerance should be used, running every point."""
+    rcfile, cutoff = setup_sweep
+    run.main(['--sweep', cutoff, '--tolerance', '0'], rcfile)
+    out, err = capsys.readouterr()
+
+    assert out.endswith(cutoff + ' not converged within 0 Ha/atom\n')
+
+
+def test_sweep_manifest(capsys, setup_sweep):
+    """The points should be read from sweep.json, and grids of several
+    parameters or directories without points should be rejected."""
+    rcfile, cutoff = setup_sweep
+    manifest = {'input': 'WS.dat', 'parameters': ['cutoff_energy'],
+                'points': [{'dir': value, 'input': value + '/WS.dat',
+                            'values': {'cutoff_energy': float(value)}}
+                           for value in ['800', '600', '700']]}
+
+    with open(os.path.join(cutoff, 'sweep.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    assert run.sweep_points(cutoff) == [
+        (float(value), os.path.join(cutoff, value))
+        for value in ['600', '700', '800']]
+
+    manifest['parameters'].append('ngwf_radius')
+
+    with open(os.path.join(cutoff, 'sweep.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    with pytest.raises(SystemExit) as e:
+        run.main(['--sweep', cutoff], rcfile)
+
+    assert 'grid of cutoff_energy, ngwf_radius' in str(e.value)
+
+    os.remove(os.path.join(cutoff, 'sweep.json'))
+
+    for value in os.listdir(cutoff):
+        if os.path.isdir(os.path.join(cutoff, value)):
+            os.rename(os.path.join(cutoff, value),
+                      os.path.join(cutoff, value + '-7'))
+
+    with pytest.raises(SystemExit) as e:
+        run.main(['--sweep', cutoff], rcfile)
+
+    assert 'No sweep points found' in str(e.value)
+
+
+@pytest.fixture
+def setup_batch(tmpdir):
+    """Create input files and a fake ONETEP which logs when it starts and
+    ends, and fails for inputs containing 'fail'."""
+    log = tmpdir.join('log.txt')
+    onetep = tmpdir.join('onetep')
+    onetep.write(
+        '#!/bin/sh\n'
+        'echo "start $1 $OMP_NUM_THREADS" >> ' + str(log) + '\n'
+        'sleep 0.2\n'
+        'echo "end $1" >> ' + str(log) + '\n'
+        'grep -q fail "$1" && exit 3\n'
+        'echo "   2     0.00000076113412 -10.5  <-- CG"\n'
+        'echo "Job completed: foo"\n')
+    os.chmod(str(onetep), 0o744)
+    rcfile = tmpdir.join('teptoolsrc')
+    rcfile.write('[run]\noptions =\npaths = ' + str(onetep) + '\n')
+    cutoff = tmpdir.mkdir('cutoff')
+
+    for value in ['600', '700', '800']:
+        cutoff.mkdir(value).join('WS.dat').write('cutoff_energy: ' + value)
+
+    tmpdir.join('fail.dat').write('fail')
+
+    return str(rcfile), tmpdir, log
+
+
+def test_run_batch(capsys, setup_batch):
+    """Many inputs should run concurrently within the core budget."""
+    rcfile, tmpdir, log = setup_batch
+    cutoff = str(tmpdir.join('cutoff'))
+    fail = str(tmpdir.join('fail.dat'))
+    run.main([cutoff, fail, '--cores', '4', '--threads', '2'], rcfile)
+    out, err = capsys.readouterr()
+    running = 0
+    max_running = 0
+
+    for line in log.readlines():
+        running += 1 if line.startswith('start') else -1
+        max_running = max(running, max_running)
+
+        if line.startswith('start'):
+            assert line.endswith(' 2\n')
+
+    assert max_running == 2
+    assert [line.split()[:3] for line in out.splitlines()[-5:]] == [
+        ['input', 'status', 'energy'],
+        [os.path.join(cutoff, '600', 'WS.dat'), 'completed', '-10.5'],
+        [os.path.join(cutoff, '700', 'WS.dat'), 'completed', '-10.5'],
+        [os.path.join(cutoff, '800', 'WS.dat'), 'completed', '-10.5'],
+        [fail, 'failed', '(3)']]
+    assert tmpdir.join('cutoff', '800', 'WS.out').check()
+
+
+def test_run_first_input(capsys, setup_batch, monkeypatch):
+    """Without any input file, only the first input file should be run, with
+    the ranks and threads given on the command line."""
+    rcfile, tmpdir, log = setup_batch
+    tmpdir.join('pass.dat').write('pass')
+    tmpdir.join('teptoolsrc').write(
+        'mpi_command = echo {ranks} > ranks.txt;\n', mode='a')
+    monkeypatch.chdir(tmpdir)
+    run.main([], rcfile)
+
+    assert [line.split()[:2] for line in log.readlines()] == [
+        ['start', 'fail.dat'], ['end', 'fail.dat']]
+    assert not tmpdir.join('ranks.txt').check()
+
+    log.remove()
+    run.main(['-n', '4', '-t', '3'], rcfile)
+
+    assert [line.split() for line in log.readlines()] == [
+        ['start', 'fail.dat', '3'], ['end', 'fail.dat']]
+    assert tmpdir.join('ranks.txt').read() == '4\n'
+
+    with pytest.raises(SystemExit):
+        run.main(['-c', '2'], rcfile)
+
+
+@pytest.mark.parametrize('args', [
+    ['--no-output'],
+    ['-a', 'help', 'all']
+])
+def test_run_batch_exit(args, setup_batch):
+    """Options which cannot apply to many jobs should be rejected."""
+    rcfile, tmpdir, log = setup_batch
+    inpfiles = [str(tmpdir.join('fail.dat')),
+                str(tmpdir.join('cutoff', '600', 'WS.dat'))]
+
+    with pytest.raises(SystemExit):
+        run.main(inpfiles + args, rcfile)
+
+    assert not log.check()
+
+
+def test_run_batch_memory(capsys, setup_batch):
+    """Jobs should also fit into the memory budget, and a job too big for
+    the budget should still run on its own."""
+    rcfile, tmpdir, log = setup_batch
+    run.main([str(tmpdir.join('cutoff')), '--cores', '8', '--memory', '4',
+              '--job-memory', '5'], rcfile)
+    out, err = capsys.readouterr()
+    lines = log.readlines()
+
+    assert [line.split()[0] for line in lines] == ['start', 'end'] * 3
+    assert out.count(' completed ') == 3
+
+
+def test_run_batch_usage(capsys, setup_batch):
+    """Each job should write its resource usage next to its output."""
+    rcfile, tmpdir, log = setup_batch
+    inpfile = tmpdir.join('cutoff', '600', 'WS.dat')
+    fail = tmpdir.join('fail.dat')
+    run.main([str(inpfile), str(fail), '-v', '1', '-t', '2'], rcfile)
+    usage = json.loads(tmpdir.join('cutoff', '600', 'WS.usage.json').read())
+
+    assert usage['input'] == str(inpfile)
+    assert usage['input_sha256'] == hashlib.sha256(
+        inpfile.read_binary()).hexdigest()
+    assert usage['output'] == str(tmpdir.join('cutoff', '600', 'WS.out'))
+    assert usage['onetep'] == str(tmpdir.join('onetep'))
+    assert (usage['version'], usage['returncode'], usage['threads']) == (
+        1, 0, 2)
+    assert usage['wall_time'] >= 0.2
+    assert usage['user_time'] >= 0 and usage['system_time'] >= 0
+    assert usage['max_rss_kb'] > 0
+    assert json.loads(tmpdir.join('fail.usage.json').read())[
+        'returncode'] == 3
+
+
+def test_batch_inputs_manifest(tmpdir):
+    """A sweep.json manifest should list the inputs of a sweep grid."""
+    grid = tmpdir.mkdir('cutoff_radius')
+    grid.join('WS.dat').write('')
+    points = []
+
+    for name in ['600-7', '600-8']:
+        grid.mkdir(name).join('WS.dat').write('')
+        points.append({'dir': name, 'input': os.path.join(name, 'WS.dat')})
+
+    grid.join('sweep.json').write(json.dumps({'points': points}))
+
+    assert run.batch_inputs([str(grid)], 'dat') == [
+        str(grid.join('600-7', 'WS.dat')), str(grid.join('600-8', 'WS.dat'))]
+
+
+def test_main_tee(capsys, tmpdir, monkeypatch):
+    """--output should write the same bytes as a redirection and print the
+    summary of the output while it is being written."""
+    outfile = os.path.abspath(os.path.join(fixtures_dir, 'two.in'))
+    expected_summary = os.path.abspath(
+        os.path.join(fixtures_dir, 'two_expected.summary'))
+    onetep = tmpdir.join('onetep')
+    onetep.write('#!/bin/sh\ncat ' + outfile + '\n')
+    os.chmod(str(onetep), 0o744)
+    rcfile = tmpdir.join('teptoolsrc')
+    rcfile.write('[run]\noptions =\npaths = ' + str(onetep) + '\n')
+    tmpdir.join('two.dat').write('')
+    monkeypatch.chdir(tmpdir)
+    run.main(['two.dat', '--output'], str(rcfile))
+    out, err = capsys.readouterr()
+
+    with open(outfile, 'rb') as f:
+        assert tmpdir.join('two.out').read_binary() == f.read()
+
+    with open(expected_summary, 'r') as f:
+        assert out == f.read()
+
+
+def test_main_tee_flush(capsys, tmpdir, monkeypatch):
+    """--output should write the output into the file while it is being
+    written, not only once the buffer is full."""
+    onetep = tmpdir.join('onetep')
+    onetep.write('#!/bin/sh\necho "first line"\nsleep 0.5\n'
+                 'wc -c < two.out > size.txt\necho "second line"\n')
+    os.chmod(str(onetep), 0o744)
+    rcfile = tmpdir.join('teptoolsrc')
+    rcfile.write('[run]\noptions =\npaths = ' + str(onetep) + '\n')
+    tmpdir.join('two.dat').write('')
+    monkeypatch.chdir(tmpdir)
+    run.main(['two.dat', '--output'], str(rcfile))
+
+    assert int(tmpdir.join('size.txt').read()) == len('first line\n')
+    assert tmpdir.join('two.out').read() == 'first line\nsecond line\n'
+
+
+def test_tee_summary_error(tmpdir, capsys):
+    """An error of the summary should not stop the output being copied."""
+    class Summary():
+        def parse_line(self, line):
+            if line == 'bad':
+                raise IndexError('list index out of range')
+
+            return line
+
+    outfile = tmpdir.join('f.out')
+    process = subprocess.Popen(['printf', 'good\\nbad\\nlater\\nend'],
+                               stdout=subprocess.PIPE)
+    run.tee(process, str(outfile), Summary())
+    process.wait()
+    out, err = capsys.readouterr()
+
+    assert outfile.read() == 'good\nbad\nlater\nend'
+    assert out == 'good\n'
+    assert 'Summary stopped' in err
@@ -4,6 +4,9 @@ All args arrays have extra default values in it to prevent custom user rc file
 interfering with the tests."""
 import os
 import glob
+import multiprocessing
+import textwrap
+import time
 import pytest
 import summarise
 
@@ -33,6 +36,41 @@ def remove_output(request):
     request.addfinalizer(fin)
 
 
+@pytest.fixture
+def running_output(request):
+    """Write half of an output file then append the rest in the background,
+    as if ONETEP were still running."""
+    outfile = 'running.out'
+
+    with open(os.path.join(fixtures_dir, 'two.in'), 'r') as f:
+        lines = f.readlines()
+
+    half = int(len(lines) / 2)
+
+    with open(outfile, 'w') as f:
+        # Finish on an incomplete line to check it is not parsed too early
+        f.writelines(lines[:half])
+        f.write(lines[half][:5])
+
+    def append_output():
+        time.sleep(0.1)
+
+        with open(outfile, 'a') as f:
+            f.write(lines[half][5:])
+            f.writelines(lines[half+1:])
+
+    d = multiprocessing.Process(target=append_output)
+    d.daemon = True
+    d.start()
+
+    def fin():
+        os.remove(outfile)
+
+    request.addfinalizer(fin)
+
+    return outfile
+
+
 def test_main_single(capsys):
     """Supplying a single outfile should print out the correct summary."""
     args = [os.path.join(fixtures_dir, 'one.out'),
@@ -109,3 +147,177 @@ def test_vimdiff():
 
     assert (not os.path.exists('one.summary') and
             not os.path.exists('two.summary'))
+
+
+def test_summary_lines():
+    """summary_lines should stream the summary without storing it."""
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    expected_file = os.path.join(fixtures_dir, 'two_expected.summary')
+    s = summarise.Summarise(outfile, 180)
+
+    with open(expected_file, 'r') as f:
+        expected = f.read().splitlines()
+
+    assert list(s.summary_lines()) == expected and s.summary == []
+
+
+def test_run_no_store(capsys):
+    """run should print every line without keeping them when store is
+    disabled."""
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    expected_file = os.path.join(fixtures_dir, 'two_expected.summary')
+    s = summarise.Summarise(outfile, 180)
+    s.run(True, False)
+    out, err = capsys.readouterr()
+
+    with open(expected_file, 'r') as f:
+        expected = f.read()
+
+    assert out == expected and s.summary == []
+
+
+def test_main_follow(capsys, running_output):
+    """--follow should keep printing new lines until the job completes."""
+    args = [running_output, '--follow', '--interval', '0.05',
+            '--no-vimdiff', '--no-output']
+    expected_file = os.path.join(fixtures_dir, 'two_expected.summary')
+    summarise.main(args, 'emptyrc')
+    out, err = capsys.readouterr()
+
+    with open(expected_file, 'r') as f:
+        expected = f.read()
+
+    assert out == expected
+
+
+def test_follow_files_stop(tmpdir):
+    """Following should stop when the job aborts or the output stops
+    growing, with every file followed at the same time."""
+    aborted = tmpdir.join('aborted.out')
+    aborted.write('Job started: 01-01-2017 00:00 (+0000)\n'
+                  'Error in energy_and_force_calculate: out of memory\n'
+                  'Job completed: never read\n')
+    stalled = tmpdir.join('stalled.out')
+    stalled.write('Job started: 01-01-2017 00:00 (+0000)\n')
+    lines = list(summarise.follow_files(
+        [str(stalled), str(aborted)], 180, 0.01, 0.05))
+
+    assert lines[:-1] == [
+        (str(stalled), 'Job started: 01-01-2017 00:00 (+0000)'),
+        (str(aborted), 'Job started: 01-01-2017 00:00 (+0000)'),
+        (str(aborted),
+         'Error in energy_and_force_calculate: out of memory')]
+    assert lines[-1][0] == str(stalled)
+    assert lines[-1][1].startswith('No new output for')
+
+
+def test_summary_lines_cache(tmpdir):
+    """Cached summaries should be the same as uncached ones, including when
+    the file has grown since it was cached."""
+    cache = summarise.helpers.ParseCache(str(tmpdir.join('cache')), 1e8)
+    outfile = str(tmpdir.join('foo.out'))
+    expected_file = os.path.join(fixtures_dir, 'two_expected.summary')
+
+    with open(os.path.join(fixtures_dir, 'two.in'), 'r') as f:
+        lines = f.readlines()
+
+    with open(expected_file, 'r') as f:
+        expected = f.read().splitlines()
+
+    half = int(len(lines) / 2)
+
+    with open(outfile, 'w') as f:
+        f.writelines(lines[:half])
+        f.write(lines[half][:5])
+
+    # The incomplete line is summarised but must not be cached
+    list(summarise.Summarise(outfile, 180, cache).summary_lines())
+
+    with open(outfile, 'a') as f:
+        f.write(lines[half][5:])
+        f.writelines(lines[half+1:])
+
+    grown = list(summarise.Summarise(outfile, 180, cache).summary_lines())
+    unchanged = list(summarise.Summarise(outfile, 180, cache).summary_lines())
+
+    assert grown == expected and unchanged == expected
+
+
+def test_main_jobs(capsys, remove_output):
+    """Parsing with a process pool should write the same summaries in the
+    same order as the outputs were given."""
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    expected_file = os.path.join(fixtures_dir, 'two_expected.summary')
+    args = [outfile, outfile, '--output', '--no-vimdiff', '-j', '2']
+    summarise.main(args, 'emptyrc')
+    out, err = capsys.readouterr()
+
+    with open(expected_file, 'r') as f:
+        expected = f.read()
+
+    for newfile in ['two.summary', 'two_1.summary']:
+        with open(newfile, 'r') as f:
+            assert f.read() == expected
+
+    assert out == (outfile + ' summary > two.summary\n' +
+                   outfile + ' summary > two_1.summary\n')
+
+
+def test_summarise_records():
+    """The records should hold the numbers of every NGWF iteration in the
+    summary."""
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    expected_file = os.path.join(fixtures_dir, 'two_expected.summary')
+    records = summarise.summarise_records(outfile, 180)
+    s = summarise.Summarise(outfile, 180)
+
+    with open(expected_file, 'r') as f:
+        expected = [line.rstrip('\n') for line in f
+                    if line[:3].strip().isdigit()]
+
+    assert [s.format_record(record) for record in records] == expected
+
+
+def test_main_format_csv(capsys):
+    """--format csv should print the records of each NGWF iteration."""
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    summarise.main([outfile, '--format', 'csv', '--no-output'], 'emptyrc')
+    out, err = capsys.readouterr()
+    lines = out.splitlines()
+
+    assert (lines[0] == ('file,iteration,rms_gradient,energy,step,'
+                         'commutator,change,status') and
+            lines[1] == (outfile + ',1,0.00018646360679,'
+                         '-14295.244408953404,2.258815,0.0014346,'
+                         '-14295.244408953404,0') and
+            lines[-1].endswith(',2'))
+
+
+def test_print_side_view_sync(capsys):
+    """The iteration headers of all the summaries should be aligned."""
+    summaries = [iter(['a', '| i|', '1']),
+                 iter(['b', 'c', '| i|', '1']),
+                 iter(['d', '| i|', '1', '2'])]
+    summarise.print_side_view(summaries, 6)
+    out, err = capsys.readouterr()
+
+    assert out.splitlines() == [
+        'a     b     d     ',
+        '--    c     --    ',
+        '| i|  | i|  | i|  ',
+        '1     1     1     ',
+        '--    --    2     ']
+
+
+def test_side_view_three_files(monkeypatch, capsys):
+    """Three outfiles should be printed side-by-side on a wide terminal."""
+    monkeypatch.setattr(summarise.helpers.subprocess, 'check_output',
+                        lambda *args, **kwargs: b'50 270')
+    outfile = os.path.join(fixtures_dir, 'two.in')
+    summarise.main([outfile] * 3 + ['--no-output', '--no-vimdiff'],
+                   'emptyrc')
+    out, err = capsys.readouterr()
+    lines = [wrapped for line in summarise.summarise_file(outfile, 90)
+             for wrapped in textwrap.wrap(line, 90)]
+
+    assert out.splitlines() == ['{:<90}'.format(line) * 3 for line in lines]
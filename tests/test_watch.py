@@ -2,6 +2,8 @@
 import os
 import shutil
 import multiprocessing
+import socketserver
+import threading
 import time
 import pytest
 import watch
@@ -168,3 +170,627 @@ def test_run(setup_run):
 
     for i in range(len(out)):
         assert out[i].endswith(expected[i])
+
+
+@pytest.mark.parametrize('inotify', ['true', 'false'])
+def test_process_dirs_changes(inotify, tmpdir, monkeypatch):
+    """Only the files that have changed should be read again."""
+    job_dir = tmpdir.mkdir('job')
+    outfile = job_dir.join('f.out')
+    outfile.write('Job started: foo\n' + 'line\n' * 10000)
+    config = {
+        'outfile_ext': 'out',
+        'interval': 1,
+        'inotify': inotify
+    }
+    w = watch.Watch([str(job_dir)], config)
+    reads = []
+    reverse_lines = watch.helpers.reverse_lines
+
+    def counted_reverse_lines(file, block_size):
+        reads.append(file)
+        return reverse_lines(file, block_size)
+
+    monkeypatch.setattr(watch.helpers, 'reverse_lines', counted_reverse_lines)
+
+    assert w.process_dirs()[0]['completed'] is False
+    assert reads == []
+
+    outfile.write('Job completed: bar\n', mode='a')
+
+    assert w.process_dirs()[0]['completed'] is True
+    assert reads == [str(outfile)]
+
+    job_dir.join('f.error_message').write('')
+
+    assert w.process_dirs()[0]['have_errfile'] is True
+    assert reads == [str(outfile)]
+
+
+def test_process_dirs_deleted(tmpdir):
+    """The states of deleted output files should be forgotten."""
+    job_dir = tmpdir.mkdir('job')
+    first = job_dir.join('first.out')
+    first.write('Job started: foo\n')
+    second = job_dir.join('second.out')
+    second.write('Job started: foo\n')
+    config = {
+        'outfile_ext': 'out',
+        'interval': 1,
+        'inotify': 'true'
+    }
+    w = watch.Watch([str(job_dir)], config)
+
+    assert sorted(w.file_states) == [str(first), str(second)]
+    assert w.progress[str(job_dir)].file == str(second)
+
+    second.remove()
+    # The listing is only read again when the mtime of the directory changes
+    os.utime(str(job_dir), ns=(0, 0))
+    w.process_dirs()
+
+    assert list(w.file_states) == [str(first)]
+    assert w.progress[str(job_dir)].file == str(first)
+
+    if w.inotify:
+        with w.inotify as inotify:
+            pass
+
+        assert inotify.fd == -1
+        inotify.close()
+
+
+def test_run_adaptive_interval(tmpdir, monkeypatch):
+    """Busy directories should be processed more often than idle ones."""
+    busy_dir = tmpdir.mkdir('busy')
+    idle_dir = tmpdir.mkdir('idle')
+    busy_dir.join('f.out').write('Job started: foo\n')
+    idle_dir.join('f.out').write('Job started: foo\n')
+    config = {
+        'outfile_ext': 'out',
+        'interval': 0.4,
+        'min_interval': 0.02,
+        'inotify': 'false',
+        'progress_interval': 0.2
+    }
+
+    def write_output():
+        for i in range(50):
+            time.sleep(0.02)
+            busy_dir.join('f.out').write('line\n', mode='a')
+
+        busy_dir.join('f.out').write('Job completed: bar\n', mode='a')
+        idle_dir.join('f.out').write('Job completed: bar\n', mode='a')
+
+    w = watch.Watch([str(busy_dir), str(idle_dir)], config)
+    calls = []
+    process_dir = w.process_dir
+
+    def counted_process_dir(d):
+        calls.append(d)
+        return process_dir(d)
+
+    monkeypatch.setattr(w, 'process_dir', counted_process_dir)
+    monkeypatch.chdir(tmpdir)
+    d = multiprocessing.Process(target=write_output)
+    d.daemon = True
+    d.start()
+    w.run()
+    d.join()
+
+    assert all(state['completed'] for state in w.prev_states)
+    assert calls.count(str(busy_dir)) > 3 * calls.count(str(idle_dir))
+    log_file, = tmpdir.listdir(lambda f: f.ext == '.log')
+
+    assert str(busy_dir) + ' running: 0 NGWF iterations' in log_file.read()
+
+
+def test_run_inotify_coalesced(tmpdir, monkeypatch):
+    """With inotify, a directory that is written to all the time should
+    still be processed at most once every min_interval seconds."""
+    job_dir = tmpdir.mkdir('job')
+    job_dir.join('f.out').write('Job started: foo\n')
+    config = {
+        'outfile_ext': 'out',
+        'interval': 5,
+        'min_interval': 0.3,
+        'inotify': 'true'
+    }
+
+    def write_output():
+        for i in range(75):
+            time.sleep(0.02)
+            job_dir.join('f.out').write('line\n', mode='a')
+
+        job_dir.join('f.out').write('Job completed: bar\n', mode='a')
+
+    w = watch.Watch([str(job_dir)], config)
+
+    if w.inotify is None:
+        pytest.skip('inotify is not available')
+
+    calls = []
+    process_dir = w.process_dir
+
+    def counted_process_dir(d):
+        calls.append(time.monotonic())
+        return process_dir(d)
+
+    monkeypatch.setattr(w, 'process_dir', counted_process_dir)
+    monkeypatch.chdir(tmpdir)
+    d = multiprocessing.Process(target=write_output)
+    d.daemon = True
+    d.start()
+    w.run()
+    d.join()
+
+    assert w.prev_states[0]['completed'] is True
+    assert 2 <= len(calls) <= (calls[-1] - calls[0]) / 0.3 + 2
+    assert all(b - a >= 0.29 for a, b in zip(calls, calls[1:]))
+
+
+@pytest.fixture
+def smtp_server(request):
+    """Run a minimal local SMTP server recording the messages received."""
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            server.connections += 1
+            self.wfile.write(b'220 localhost\r\n')
+
+            for line in self.rfile:
+                command = line.strip().upper()
+
+                if command.startswith(b'DATA'):
+                    self.wfile.write(b'354 End data with .\r\n')
+                    message = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                    server.messages.append(message.decode())
+                    self.wfile.write(b'250 OK\r\n')
+                elif command.startswith(b'QUIT'):
+                    self.wfile.write(b'221 Bye\r\n')
+                    break
+                else:
+                    self.wfile.write(b'250 OK\r\n')
+
+    server = socketserver.ThreadingTCPServer(('localhost', 0), Handler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.messages = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    def fin():
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(fin)
+
+    return server
+
+
+def test_notifier_email(smtp_server):
+    """Digests should be sent through one SMTP connection."""
+    config = {
+        'email': 'foo@bar.com',
+        'smtp_host': 'localhost',
+        'smtp_port': smtp_server.server_address[1],
+        'notify_window': 0
+    }
+    notifier = watch.notifier(config)
+    notifier.add('[01/01/17 00:00:00] foo successfully completed\n')
+    notifier.add('[01/01/17 00:00:01] bar failed\n')
+    notifier.flush()
+    notifier.add('[01/01/17 00:00:02] baz successfully completed\n')
+    notifier.close()
+
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 2
+    assert 'foo successfully completed' in smtp_server.messages[0]
+    assert 'bar failed' in smtp_server.messages[0]
+    assert 'baz' not in smtp_server.messages[0]
+    assert 'baz successfully completed' in smtp_server.messages[1]
+
+
+def test_notifier_file_command(tmpdir):
+    """File and command sinks should receive each digest once."""
+    notify_file = tmpdir.join('notify.log')
+    command_file = tmpdir.join('command.log')
+    config = {
+        'notify_file': str(notify_file),
+        'notify_command': 'cat >> ' + str(command_file),
+        'notify_window': 60
+    }
+    notifier = watch.notifier(config)
+
+    assert notifier.due() is None
+
+    notifier.add('foo failed\n')
+    notifier.add('bar successfully completed\n')
+
+    assert notifier.due() > time.monotonic()
+
+    notifier.flush()
+    notifier.flush()
+
+    assert notify_file.read() == 'foo failed\nbar successfully completed\n'
+    assert command_file.read() == notify_file.read()
+
+
+def test_run_notify(tmpdir, monkeypatch):
+    """The events of a run should be sent once the watch has finished."""
+    job_dir = tmpdir.mkdir('job')
+    job_dir.join('f.out').write('Job started: foo\n')
+    notify_file = tmpdir.join('notify.log')
+    config = {
+        'outfile_ext': 'out',
+        'interval': 0.1,
+        'notify_file': str(notify_file),
+        'notify_window': 3600
+    }
+
+    def complete():
+        time.sleep(0.1)
+        job_dir.join('f.out').write('Job completed: bar\n', mode='a')
+
+    monkeypatch.chdir(tmpdir)
+    w = watch.Watch([str(job_dir)], config)
+    d = multiprocessing.Process(target=complete)
+    d.daemon = True
+    d.start()
+    w.run()
+    log_file, = tmpdir.listdir(lambda f: f.ext == '.log' and
+                               f.basename.startswith('teptools-'))
+
+    assert notify_file.read().endswith(' successfully completed\n')
+    assert notify_file.read() == log_file.read()
+
+
+def test_job_store_resume(tmpdir, monkeypatch):
+    """A restarted watch should only read the files that changed meanwhile
+    and report the jobs that finished while it was stopped."""
+    running_dir = tmpdir.mkdir('running')
+    finished_dir = tmpdir.mkdir('finished')
+    running_dir.join('f.out').write('Job started: foo\n')
+    finished_dir.join('f.out').write('Job started: foo\n')
+    config = {
+        'outfile_ext': 'out',
+        'interval': 0.1,
+        'inotify': 'false',
+        'state_db': str(tmpdir.join('state.sqlite'))
+    }
+    watch_dirs = [str(running_dir), str(finished_dir)]
+    watch.Watch(watch_dirs, config).store.close()
+    finished_dir.join('f.out').write('Job completed: bar\n', mode='a')
+    reads = []
+    reverse_lines = watch.helpers.reverse_lines
+
+    def counted_reverse_lines(file, block_size):
+        reads.append(file)
+        return reverse_lines(file, block_size)
+
+    monkeypatch.setattr(watch.helpers, 'reverse_lines', counted_reverse_lines)
+    w = watch.Watch(watch_dirs, config)
+
+    assert reads == [str(finished_dir.join('f.out'))]
+    assert [state['completed'] for state in w.prev_states] == [False, True]
+
+    running_dir.join('f.error_message').write('')
+    monkeypatch.chdir(tmpdir)
+    w.run()
+    store = watch.JobStore(config['state_db'])
+    log_file = store.log_file('')
+
+    with open(log_file, 'r') as f:
+        log = f.read()
+
+    assert str(finished_dir) + ' successfully completed\n' in log
+
+    assert [row[:2] for row in store.jobs()] == [
+        (str(finished_dir), 'completed'), (str(running_dir), 'failed')]
+    assert [row[:2] for row in store.jobs([str(running_dir)])] == [
+        (str(running_dir), 'failed')]
+
+
+def test_job_store_rerun(tmpdir, monkeypatch):
+    """A completed job that has been run again should be watched again."""
+    job_dir = tmpdir.mkdir('job')
+    job_dir.join('f.out').write('Job started: foo\nJob completed: bar\n')
+    config = {
+        'outfile_ext': 'out',
+        'interval': 0.1,
+        'inotify': 'false',
+        'state_db': str(tmpdir.join('state.sqlite'))
+    }
+    monkeypatch.chdir(tmpdir)
+    w = watch.Watch([str(job_dir)], config)
+    w.run()
+    job_dir.join('f.out').write('Job started: foo\n')
+    w = watch.Watch([str(job_dir)], config)
+
+    assert [row[1] for row in w.store.jobs()] == ['running']
+
+    job_dir.join('f.out').write('Job completed: bar\n', mode='a')
+    w.run()
+    store = watch.JobStore(config['state_db'])
+
+    assert [row[1] for row in store.jobs()] == ['completed']
+    assert [row[1] for row in store.db.execute(
+        'SELECT * FROM transitions ORDER BY time')] == [
+            'completed', 'running', 'completed']
+
+
+def test_main_status(tmpdir, capsys):
+    """--status should print the stored status of the jobs."""
+    state_db = tmpdir.join('state.sqlite')
+    rcfile = tmpdir.join('teptoolsrc')
+    rcfile.write('[watch]\noptions =\nstate_db = ' + str(state_db) + '\n')
+    job_dir = tmpdir.mkdir('job')
+    job_dir.join('f.out').write('Job started: foo\n')
+    config = {
+        'outfile_ext': 'out',
+        'interval': 1,
+        'state_db': str(state_db)
+    }
+    watch.Watch([str(job_dir)], config).store.close()
+    watch.main(['--status'], str(rcfile))
+    out, err = capsys.readouterr()
+
+    assert out.startswith(
+        os.path.relpath(str(job_dir)) + '  running    since ')
+    assert out.endswith('  0 NGWF iterations\n')
+
+
+def test_progress(tmpdir):
+    """Reading an output file in parts should give the same progress as
+    reading it at once."""
+    with open(os.path.join(fixtures_dir, 'two.in'), 'rb') as f:
+        content = f.read()
+
+    outfile = tmpdir.join('f.out')
+    first_part = content.index(b'\n', 2 * len(content) // 5) + 10
+    outfile.write(content[:first_part], mode='wb')
+    progress = watch.Progress(str(outfile))
+    progress.update()
+
+    assert progress.geometry is True
+    assert progress.threshold == 8e-7
+    assert progress.offset < first_part
+
+    outfile.write(content[first_part:], mode='ab')
+    progress.update()
+    full = watch.Progress(os.path.join(fixtures_dir, 'two.in'))
+    full.tail_size = len(content)
+    full.update()
+
+    assert progress.offset == full.offset == len(content)
+    assert (progress.iterations, progress.optimisations,
+            progress.bfgs_steps) == (full.iterations, full.optimisations,
+                                     full.bfgs_steps) == (24, 4, 2)
+
+
+def test_progress_tail(tmpdir):
+    """A long output file without saved progress should only be parsed from
+    its header and its tail."""
+    with open(os.path.join(fixtures_dir, 'two.in'), 'rb') as f:
+        content = f.read()
+
+    outfile = tmpdir.join('f.out')
+    outfile.write(content, mode='wb')
+    progress = watch.Progress(str(outfile))
+    progress.header_size = len(content) // 4
+    progress.tail_size = len(content) // 4
+    progress.update()
+    full = watch.Progress(os.path.join(fixtures_dir, 'two.in'))
+    full.tail_size = len(content)
+    full.update()
+
+    assert full.partial is False
+    assert progress.partial is True
+    assert progress.offset == len(content)
+    assert (progress.geometry, progress.threshold) == (True, 8e-7)
+    assert 0 < progress.iterations < full.iterations
+    assert progress.rate() is None
+    assert progress.description().startswith(
+        '{}+ NGWF iterations'.format(progress.iterations))
+
+
+@pytest.mark.parametrize('lines', [
+    ['task GEOMETRYOPTIMIZATION', 'ngwf_threshold_orig = 8e-7'],
+    ['task: geometryoptimization', 'ngwf_threshold_orig 0.0000008'],
+    ['task : GeometryOptimization', 'ngwf_threshold_orig : 8.0E-07']])
+def test_progress_keywords(tmpdir, lines):
+    """Keywords should be read whatever their key value separator."""
+    outfile = tmpdir.join('f.out')
+    outfile.write('\n'.join(lines + ['task', 'ngwf_threshold_orig : x']) +
+                  '\n')
+    progress = watch.Progress(str(outfile))
+    progress.update()
+
+    assert progress.geometry is True
+    assert progress.threshold == 8e-7
+
+
+def test_update_progress_error(tmpdir, monkeypatch):
+    """An error parsing the output of a job should not stop the watch."""
+    job_dir = tmpdir.mkdir('job')
+    job_dir.join('f.out').write('Job started: foo\n')
+    w = watch.Watch([str(job_dir)], {'outfile_ext': 'out', 'interval': 1,
+                                     'inotify': 'false'})
+
+    def parse_line(self, line):
+        raise IndexError('list index out of range')
+
+    monkeypatch.setattr(watch.Progress, 'parse_line', parse_line)
+    job_dir.join('f.out').write('line\n', mode='a')
+
+    assert w.process_dirs()[0]['completed'] is False
+
+
+def test_progress_time_left(tmpdir):
+    """The time left should extrapolate the RMS NGWF gradient trend."""
+    outfile = tmpdir.join('f.out')
+    outfile.write('Job started: 01-01-2017 00:00 (+0000)\n'
+                  'ngwf_threshold_orig : 0.0000008\n')
+    progress = watch.Progress(str(outfile))
+    progress.update()
+    progress.iterations = 3
+    progress.gradients = [1e-5, 5e-6, 2.5e-6]
+    progress.mtime = progress.start_time + 3600
+
+    assert progress.remaining_iterations() == 2
+    assert progress.time_left() == pytest.approx(2400)
+    assert progress.description() == (
+        '3 NGWF iterations, RMS gradient 2.50e-06, 3.0 iterations/h, '
+        'about 0:40:00 left')
+
+    progress.gradients = [1e-5, 2e-5, 1e-5]
+
+    assert progress.time_left() is None
+
+
+def test_progress_problems(tmpdir):
+    """The detectors should only fire when their settings are reached."""
+    outfile = tmpdir.join('f.out')
+    outfile.write('Job started: 01-01-2017 00:00 (+0000)\n' +
+                  'WARNING: slope along search direction\n' * 2)
+    progress = watch.Progress(str(outfile))
+    progress.update()
+
+    assert progress.warnings == 2
+    assert progress.problems(60, 4, 3) == []
+
+    progress.mtime = time.time() - 3600
+    progress.changes = [-1.0, 0.1, -0.2, 0.1, -0.1]
+    progress.warnings = 3
+
+    assert progress.problems(60, 4, 3) == [
+        ('stall', 'no output for 60 minutes'),
+        ('oscillation', 'energy rose in 2 of the last 4 NGWF iterations'),
+        ('warnings', '3 MAXIT or slope warnings without converging')]
+    assert progress.problems(0, 0, 0) == []
+
+
+def test_run_kill(tmpdir, monkeypatch):
+    """A stalled job should be reported and stopped by the kill command."""
+    job_dir = tmpdir.mkdir('job')
+    outfile = job_dir.join('f.out')
+    outfile.write('Job started: foo\n')
+    os.utime(str(outfile), (time.time() - 600, time.time() - 600))
+    notify_file = tmpdir.join('notify.log')
+    config = {
+        'outfile_ext': 'out',
+        'interval': 0.1,
+        'notify_file': str(notify_file),
+        'stall_minutes': 5,
+        'kill_command': 'touch killed.error_message'
+    }
+    monkeypatch.chdir(tmpdir)
+    watch.Watch([str(job_dir)], config).run()
+    log = notify_file.read().splitlines()
+
+    assert log[0].endswith(
+        str(job_dir) + ' no output for 10 minutes, ran touch '
+        'killed.error_message (exit code 0)')
+    assert log[1].endswith(str(job_dir) + ' failed')
+    assert job_dir.join('killed.error_message').check()
+
+
+def test_run_kill_quoted(tmpdir, monkeypatch):
+    """The kill command should keep its other braces and get the paths
+    quoted."""
+    job_dir = tmpdir.mkdir('my job')
+    outfile = job_dir.join('f.out')
+    outfile.write('Job started: foo\n')
+    os.utime(str(outfile), (time.time() - 600, time.time() - 600))
+    config = {
+        'outfile_ext': 'out',
+        'interval': 0.1,
+        'notify_file': str(tmpdir.join('notify.log')),
+        'stall_minutes': 5,
+        'kill_command': "awk '{print $1}' {outfile} > {dir}/first.txt; "
+                        "touch killed.error_message"
+    }
+    monkeypatch.chdir(tmpdir)
+    watch.Watch([str(job_dir)], config).run()
+
+    assert job_dir.join('first.txt').read() == 'Job\n'
+    assert job_dir.join('killed.error_message').check()
+
+
+@pytest.fixture
+def fake_squeue(tmpdir, monkeypatch):
+    """Put a fake squeue on PATH that prints the contents of queue.txt and
+    counts its calls in calls.txt."""
+    bin_dir = tmpdir.mkdir('bin')
+    squeue = bin_dir.join('squeue')
+    squeue.write('#!/bin/sh\n'
+                 'echo >> {0}/calls.txt\n'
+                 'cat {0}/queue.txt\n'.format(tmpdir))
+    squeue.chmod(0o755)
+    tmpdir.join('queue.txt').write('')
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+
+    return tmpdir
+
+
+def test_scheduler(fake_squeue):
+    """The jobs should be read with one cached squeue call."""
+    fake_squeue.join('queue.txt').write(
+        '12|PENDING|/foo\n13|RUNNING|/bar/\n')
+    s = watch.Scheduler('slurm', 60)
+
+    assert s.jobs() == {'/foo': ('12', 'queued'), '/bar': ('13', 'running')}
+    assert s.jobs() == s.jobs()
+    assert len(fake_squeue.join('calls.txt').readlines()) == 1
+
+
+def test_parse_qstat():
+    """The work dirs and states should be read from qstat -f."""
+    output = ('Job Id: 1.server\n'
+              '    job_state = R\n'
+              '    Variable_List = PBS_O_HOME=/home/foo,PBS_O_WORKDIR=/wo\n'
+              '\trk/a,PBS_O_SHELL=/bin/sh\n'
+              '\n'
+              'Job Id: 2.server\n'
+              '    job_state = Q\n'
+              '    Variable_List = PBS_O_WORKDIR=/work/b\n')
+
+    assert watch.Scheduler.parse_qstat(output) == [
+        ('1.server', 'R', '/work/a'), ('2.server', 'Q', '/work/b')]
+
+
+def test_run_scheduler(fake_squeue, monkeypatch):
+    """A job that leaves the queue without completing should be reported,
+    with one squeue call per poll for all the jobs."""
+    lost_dir = fake_squeue.mkdir('lost')
+    completed_dir = fake_squeue.mkdir('completed')
+    completed_dir.join('f.out').write('Job started: foo\n')
+    fake_squeue.join('queue.txt').write(
+        '1|PENDING|{}\n2|RUNNING|{}\n'.format(lost_dir, completed_dir))
+    config = {
+        'outfile_ext': 'out',
+        'interval': 0.05,
+        'inotify': 'false',
+        'scheduler': 'slurm',
+        'state_db': str(fake_squeue.join('state.sqlite'))
+    }
+
+    def finish():
+        time.sleep(0.2)
+        completed_dir.join('f.out').write('Job completed: bar\n', mode='a')
+        fake_squeue.join('queue.txt').write('')
+
+    monkeypatch.chdir(fake_squeue)
+    w = watch.Watch([str(lost_dir), str(completed_dir)], config)
+    d = multiprocessing.Process(target=finish)
+    d.daemon = True
+    d.start()
+    w.run()
+    log_file, = fake_squeue.listdir(lambda f: f.ext == '.log')
+    log = sorted(line.split('] ')[1] for line in log_file.readlines())
+    store = watch.JobStore(config['state_db'])
+
+    assert log == [str(completed_dir) + ' successfully completed\n',
+                   str(lost_dir) + ' left the queue without completing\n']
+    assert [row[1] for row in store.jobs()] == ['completed', 'lost']
+    assert len(fake_squeue.join('calls.txt').readlines()) < 10